@@ -1,4 +1,7 @@
 import argparse
+import inspect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import lpips
@@ -6,12 +9,15 @@ import torch as th
 import wandb
 from PIL import Image
 import torchvision.transforms as tvt
+from torch.utils.checkpoint import checkpoint
 
 from tqdm.auto import tqdm
 from cgd import losses
 from cgd import clip_util
 from cgd import script_util
 
+# Reentrant checkpointing raises under `th.autograd.grad`, only the non-reentrant variant (torch >= 1.11) can be used in `cond_fn`.
+NON_REENTRANT_CHECKPOINT = "use_reentrant" in inspect.signature(checkpoint).parameters
 
 # Define necessary functions
 
@@ -46,6 +52,9 @@ def clip_guided_diffusion(
     use_augs: bool = False, # enables augmentation, mostly better for timesteps <= 100
     use_magnitude: bool = False, # enables magnitude of the gradient
     progress: bool = True,
+    free_text_encoder: bool = False, # frees the clip text encoder once prompts are encoded
+    use_cuda_graphs: bool = False, # replays the clip image encoder from a CUDA graph, requires torch >= 1.10
+    use_checkpoint: bool = False, # gradient checkpointing, trades compute for VRAM
 ):
     if len(device) == 0:
         device = 'cuda' if th.cuda.is_available() else 'cpu'
@@ -53,6 +62,9 @@ def clip_guided_diffusion(
     else:
         print(f"Using device {device}")
     fp32_diffusion = (device == 'cpu')
+    use_amp = "cuda" in device  # clip guidance runs under fp16 autocast on gpu
+    if use_cuda_graphs and not use_amp:
+        raise ValueError("--cuda_graphs requires a cuda device")
 
     wandb_run = None
     if wandb_project is not None:
@@ -78,11 +90,11 @@ def clip_guided_diffusion(
     weights_list = []
     clip_model, clip_size = clip_util.load_clip(clip_model_name, device)
 
-    for prompt in prompts:
-        text, weight = script_util.parse_prompt(prompt)
-        text, weight = clip_util.encode_text_prompt(text, weight, clip_model_name, device)
-        embeds_list.append(text)
-        weights_list.append(weight)
+    if len(prompts) > 0:
+        texts, text_weights = zip(*[script_util.parse_prompt(prompt) for prompt in prompts])
+        text_embeds, text_weights = clip_util.encode_text_prompts(texts, text_weights, clip_model_name, device)
+        embeds_list.append(text_embeds)
+        weights_list.extend(text_weights)
 
     for image_prompt in image_prompts:
         img, weight = script_util.parse_prompt(image_prompt)
@@ -92,6 +104,8 @@ def clip_guided_diffusion(
         weights_list.extend(batched_weight)
 
     target_embeds = th.cat(embeds_list)
+    if free_text_encoder:
+        clip_util.free_text_encoder(clip_model)
 
     weights = th.tensor(weights_list, device=device)
     if weights.sum().abs() < 1e-3:  # smart :)
@@ -100,7 +114,12 @@ def clip_guided_diffusion(
 
     if use_augs: tqdm.write( f"Augmentations enabled." )
     make_cutouts = clip_util.MakeCutouts(cut_size=clip_size, num_cutouts=num_cutouts,
-                                         cutout_size_power=cutout_power, use_augs=use_augs)
+                                         cutout_size_power=cutout_power, use_augs=use_augs,
+                                         mean=clip_util.CLIP_MEAN, std=clip_util.CLIP_STD).to(device)
+    encode_image = clip_model.encode_image
+    if use_cuda_graphs:
+        tqdm.write("Capturing CUDA graphs for the clip image encoder.")
+        encode_image = clip_util.graph_image_encoder(clip_model, num_cutouts * batch_size, clip_size)
 
     # Load initial image (if provided)
     init_tensor = None
@@ -125,7 +144,14 @@ def clip_guided_diffusion(
         device=device,
         noise_schedule=noise_schedule,
         dropout=dropout,
+        use_checkpoint=use_checkpoint,
     )
+    # Randomized classes are drawn for every step up front and copied into `y` between steps
+    presampled_classes = None
+    if class_cond and randomize_class:
+        presampled_classes = th.randint(0, gd_model.num_classes, [diffusion.num_timesteps - skip_timesteps, batch_size],
+                                        device=device, dtype=th.long)
+        model_kwargs["y"].copy_(presampled_classes[0])
     # This is initialized lazily as it can use a bit of VRAM
     if init_tensor is not None and init_scale != 0:
         lpips_vgg = lpips.LPIPS(net='vgg').to(device)
@@ -134,9 +160,8 @@ def clip_guided_diffusion(
     def cond_fn(x, t, out, y=None):
         log = {}
         n = x.shape[0]
-        fac = diffusion.sqrt_one_minus_alphas_cumprod[current_timestep]
-        sigmas = 1 - fac
-        x_in = out["pred_xstart"] * fac + x * sigmas
+        fac = float(diffusion.sqrt_one_minus_alphas_cumprod[current_timestep])
+        x_in = th.lerp(x, out["pred_xstart"], fac)  # pred_xstart * fac + x * (1 - fac)
         if wandb_project is not None:
             log[f'Generations - {timestep_respacing}'] = [
                 wandb.Image(x, caption=f"Noisy Sample"),
@@ -145,12 +170,17 @@ def clip_guided_diffusion(
                 wandb.Image(x_in, caption=f"Blended (what CLIP sees)"),
             ]
 
-        clip_in = clip_util.CLIP_NORMALIZE(make_cutouts(x_in.add(1).div(2)))
-        cutout_embeds = clip_model.encode_image(
-            clip_in).float().view([num_cutouts, n, -1])
-        dists = losses.spherical_dist_loss(
-            cutout_embeds.unsqueeze(0), target_embeds.unsqueeze(0))
-        dists = dists.view([num_cutouts, n, -1])
+        with th.cuda.amp.autocast(enabled=use_amp):
+            clip_in = make_cutouts(x_in)
+            if use_amp:
+                clip_in = clip_in.half().contiguous(memory_format=th.channels_last)
+            if use_checkpoint and NON_REENTRANT_CHECKPOINT:
+                cutout_embeds = checkpoint(encode_image, clip_in, use_reentrant=False)
+            else:
+                cutout_embeds = encode_image(clip_in)
+            cutout_embeds = cutout_embeds.view([num_cutouts, n, -1])
+            dists = losses.pairwise_spherical_dist_loss(
+                cutout_embeds, target_embeds).float()
 
         clip_losses = dists.mul(weights).sum(2).mean(0)
         range_losses = losses.range_loss(out["pred_xstart"])
@@ -211,19 +241,46 @@ def clip_guided_diffusion(
             progress=progress,
             skip_timesteps=skip_timesteps,
             init_image=init_tensor,
-            randomize_class=randomize_class,
+            randomize_class=False,  # handled by `presampled_classes`
             cond_fn_with_grad=True,
             # denoised_fn=denoised_fn,
         )
 
+        def save_image(copied, image_tensor, step, batch_idx):
+            if copied is not None:
+                copied.synchronize()  # wait for the non-blocking copy off the gpu
+            return script_util.log_image(image_tensor, prefix_path, prompts, step, batch_idx)
+
         # Gather generator for diffusion
-        current_timestep = diffusion.num_timesteps - 1
-        for step, sample in enumerate(cgd_samples):
-            current_timestep -= 1
-            if step % save_frequency == 0 or current_timestep == -1:
-                for batch_idx, image_tensor in enumerate(sample["pred_xstart"]):
-                    yield batch_idx, script_util.log_image(image_tensor, prefix_path, prompts, step, batch_idx)
-                    # if wandb_project is not None: wandb.log({"image": wandb.Image(image_tensor, caption="|".join(prompts))})
+        # Images are written to disk on a background thread while diffusion continues.
+        # Paths are yielded in order once their file exists.
+        pending_saves = deque()
+        with ThreadPoolExecutor(max_workers=1) as image_saver:
+            # The sampler starts `skip_timesteps` into the respaced schedule.
+            current_timestep = diffusion.num_timesteps - 1 - skip_timesteps
+            for step, sample in enumerate(cgd_samples):
+                current_timestep -= 1
+                if presampled_classes is not None and step + 1 < len(presampled_classes):
+                    model_kwargs["y"].copy_(presampled_classes[step + 1])
+                if step % save_frequency == 0 or current_timestep == -1:
+                    pred_xstart = sample["pred_xstart"].detach()
+                    copied = None
+                    if pred_xstart.is_cuda:
+                        images = th.empty(pred_xstart.shape, dtype=pred_xstart.dtype, pin_memory=True)
+                        images.copy_(pred_xstart, non_blocking=True)
+                        copied = th.cuda.Event()
+                        copied.record()
+                    else:
+                        images = pred_xstart
+                    for batch_idx, image_tensor in enumerate(images):
+                        pending_saves.append((batch_idx, image_saver.submit(save_image, copied, image_tensor, step, batch_idx)))
+                        # if wandb_project is not None: wandb.log({"image": wandb.Image(image_tensor, caption="|".join(prompts))})
+                while pending_saves and pending_saves[0][1].done():
+                    batch_idx, saved = pending_saves.popleft()
+                    yield batch_idx, saved.result()
+            while pending_saves:
+                batch_idx, saved = pending_saves.popleft()
+                yield batch_idx, saved.result()
 
         for batch_idx in range(batch_size):
             script_util.create_gif(prefix_path, prompts, batch_idx)
@@ -298,10 +355,20 @@ def main():
                    help='(optional) Name of W&B team/entity to log to.')
     p.add_argument('--use_augs', '-augs', action='store_true', help="Uses augmentations from the `quick` clip guided diffusion notebook")
     p.add_argument('--use_magnitude', '-mag', action='store_true', help="Uses magnitude of the gradient")
+    p.add_argument('--cuda_graphs', '-graphs', action='store_true',
+                   help='Replay the CLIP image encoder from CUDA graphs. Requires torch >= 1.10.')
+    p.add_argument('--use_checkpoint', '-gradckpt', action='store_true',
+                   help='Recompute diffusion and CLIP activations during the backward pass. Uses less VRAM but is slower. CLIP is only checkpointed with torch >= 1.11.')
     p.add_argument('--quiet', '-q', action='store_true',
                    help='Suppress output.')
     args = p.parse_args()
 
+    # Process wide settings, so they are only made by the CLI and left to in-process callers of `clip_guided_diffusion`.
+    # TF32 matmuls/convolutions and cudnn autotuning speed up the UNet and CLIP on Ampere+ gpus; shapes are fixed per run.
+    th.backends.cuda.matmul.allow_tf32 = True
+    th.backends.cudnn.allow_tf32 = True
+    th.backends.cudnn.benchmark = True
+
     _class_cond = not args.uncond
     prefix_path = args.prefix
 
@@ -347,6 +414,9 @@ def main():
         use_augs=args.use_augs,
         use_magnitude=args.use_magnitude,
         progress=not args.quiet,
+        free_text_encoder=True,
+        use_cuda_graphs=args.cuda_graphs,
+        use_checkpoint=args.use_checkpoint,
     )
     list(enumerate(cgd_generator))  # iterate over generator
 
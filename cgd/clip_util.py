@@ -1,8 +1,10 @@
+import hashlib
+import os
 from functools import lru_cache
+from pathlib import Path
 
 import clip
 import torch as th
-import torch.nn.functional as tf
 import torchvision.transforms as tvt
 import torchvision.transforms.functional as tvf
 from data.imagenet1000_clsidx_to_labels import IMAGENET_CLASSES
@@ -14,59 +16,153 @@ from cgd.ResizeRight import resize_right
 from cgd.ResizeRight.interp_methods import lanczos3
 
 CLIP_MODEL_NAMES = ("ViT-B/16", "ViT-B/32", "RN50", "RN101", "RN50x4", "RN50x16")
-CLIP_NORMALIZE = tvt.Normalize(mean=[0.48145466, 0.4578275, 0.40821073], std=[0.26862954, 0.26130258, 0.27577711])
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+CLIP_NORMALIZE = tvt.Normalize(mean=CLIP_MEAN, std=CLIP_STD)
+IMAGENET_PROMPT_TEMPLATE = "an image of a {}"
 
 @lru_cache(maxsize=1)
 def load_clip(model_name='ViT-B/32', device="cpu"):
     print(f"Loading clip model\t{model_name}\ton device\t{device}.")
     if device == "cpu":
         clip_model = clip.load(model_name, jit=False)[
-            0].eval().to(device=device).float()
+            0].eval().requires_grad_(False).to(device=device).float()
         clip_size = clip_model.visual.input_resolution
         return clip_model, clip_size
     elif "cuda" in device:
+        # `clip.load` already gives fp16 conv/linear/attention weights (LayerNorm stays fp32),
+        # channels_last lets cudnn pick tensor core kernels for the image encoder
         clip_model = clip.load(model_name, jit=False)[
-            0].eval().requires_grad_(False).to(device)
+            0].eval().requires_grad_(False).to(device, memory_format=th.channels_last)
         clip_size = clip_model.visual.input_resolution
         return clip_model, clip_size
     else:
         raise ValueError("Invalid or unspecified device: {}".format(device))
 
 
-def imagenet_top_n(text_encodes, device: str = 'cuda', n: int = len(IMAGENET_CLASSES), clip_model_name: str = "ViT-B/32"):
+def load_imagenet_features(clip_model_name: str = "ViT-B/32", device: str = 'cuda', checkpoints_dir: str = None):
     """
-    Returns the top n classes for a given clip model.
+    Returns the normalized clip text features of every ImageNet class prompt.
+    The features are cached to `checkpoints_dir` per clip model and prompt template.
     """
+    if checkpoints_dir is None:
+        checkpoints_dir = script_util.CACHE_PATH
+    template_hash = hashlib.md5(IMAGENET_PROMPT_TEMPLATE.encode()).hexdigest()[:8]
+    cache_path = Path(checkpoints_dir).joinpath(f"imagenet_clip_{clip_model_name.replace('/', '_')}_{template_hash}.pt")
+    if cache_path.exists():
+        return th.load(cache_path, map_location=device)
     clip_model, _ = load_clip(model_name=clip_model_name, device=device)
     with th.no_grad():
         engineered_pronmpts = [
-            f"an image of a {img_cls}" for img_cls in IMAGENET_CLASSES]
-        imagenet_lbl_tokens = clip.tokenize(engineered_pronmpts).to(device)
-        imagenet_features = clip_model.encode_text(imagenet_lbl_tokens).float()
+            IMAGENET_PROMPT_TEMPLATE.format(img_cls) for img_cls in IMAGENET_CLASSES]
+        imagenet_lbl_tokens = tokenize(tuple(engineered_pronmpts), device)
+        imagenet_features = encode_text_truncated(clip_model, imagenet_lbl_tokens).float()
         imagenet_features /= imagenet_features.norm(dim=-1, keepdim=True)
+    os.makedirs(checkpoints_dir, exist_ok=True)
+    # Written to a per-process temporary file first so interrupted or concurrent runs never leave a partial cache.
+    cache_path_tmp = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    th.save(imagenet_features.cpu(), cache_path_tmp)
+    os.replace(cache_path_tmp, cache_path)
+    return imagenet_features
+
+
+@lru_cache(maxsize=8)
+def tokenize(txts: tuple, device: str = "cpu"):
+    """
+    Tokenizes a tuple of strings once per device, later calls reuse the tokens already on device.
+    """
+    return clip.tokenize(list(txts)).to(device)
+
+
+def encode_text_truncated(clip_model, tokens):
+    """
+    Same as `clip_model.encode_text`, but the transformer only runs over the longest unpadded prompt instead of all 77 tokens.
+    The causal mask means the features at each end-of-text token are unchanged.
+    """
+    # Token id 0 is "!" as well as padding, so the length comes from the end-of-text token (the largest id) instead.
+    context_length = int(tokens.argmax(dim=-1).max()) + 1
+    tokens = tokens[:, :context_length]
+    x = clip_model.token_embedding(tokens).type(clip_model.dtype)
+    x = x + clip_model.positional_embedding[:context_length].type(clip_model.dtype)
+    x = x.permute(1, 0, 2)  # NLD -> LND
+    for block in clip_model.transformer.resblocks:
+        attn_mask = block.attn_mask[:context_length, :context_length].to(dtype=x.dtype, device=x.device)
+        attn_in = block.ln_1(x)
+        x = x + block.attn(attn_in, attn_in, attn_in, need_weights=False, attn_mask=attn_mask)[0]
+        x = x + block.mlp(block.ln_2(x))
+    x = x.permute(1, 0, 2)  # LND -> NLD
+    x = clip_model.ln_final(x).type(clip_model.dtype)
+    return x[th.arange(x.shape[0]), tokens.argmax(dim=-1)] @ clip_model.text_projection
+
+
+def free_text_encoder(clip_model):
+    """
+    Deletes the text tower of a clip model, leaving only `encode_image` usable.
+    The model is evicted from the `load_clip` cache so later calls get a complete model.
+    """
+    for name in ("transformer", "token_embedding", "positional_embedding", "ln_final", "text_projection"):
+        delattr(clip_model, name)
+    load_clip.cache_clear()
+    if th.cuda.is_available():
+        th.cuda.empty_cache()
+
+
+def graph_image_encoder(clip_model, batch_size: int, clip_size: int):
+    """
+    Captures the forward and backward of the clip image encoder into CUDA graphs for a fixed batch of cutouts.
+    Returns a replacement for `clip_model.encode_image`; the cached model itself is left untouched.
+    """
+    if not hasattr(th.cuda, "make_graphed_callables"):
+        raise RuntimeError("CUDA graphs require torch >= 1.10")
+    sample_input = th.randn([batch_size, 3, clip_size, clip_size], device=clip_model.visual.conv1.weight.device,
+                            dtype=clip_model.dtype).contiguous(memory_format=th.channels_last).requires_grad_()
+    graphed_visual = th.cuda.make_graphed_callables(clip_model.visual.forward, (sample_input,))
+    return lambda image: graphed_visual(image.type(clip_model.dtype))
+
+
+def imagenet_top_n(text_encodes, device: str = 'cuda', n: int = len(IMAGENET_CLASSES), clip_model_name: str = "ViT-B/32", checkpoints_dir: str = None, imagenet_features=None):
+    """
+    Returns the top n classes for already encoded text, in no particular order.
+    Pass `imagenet_features` from `load_imagenet_features` to reuse them across calls.
+    """
+    if n >= len(IMAGENET_CLASSES):  # every class is kept, nothing to rank
+        return th.arange(len(IMAGENET_CLASSES), device=device)
+    if imagenet_features is None:
+        imagenet_features = load_imagenet_features(clip_model_name, device, checkpoints_dir)
+    with th.no_grad():
         prompt_features = text_encodes / \
             text_encodes.norm(dim=-1, keepdim=True)
         text_probs = (100.0 * prompt_features @
                       imagenet_features.T).softmax(dim=-1)
-        return text_probs.topk(n, dim=-1, sorted=True).indices[0].to(device)
+        return text_probs.topk(n, dim=-1, sorted=False).indices[0]
 
 
 def encode_image_prompt(image: str, weight: float, diffusion_size: int, num_cutouts, clip_model_name: str = "ViT-B/32", device: str = "cpu"):
     clip_model, clip_size = load_clip(clip_model_name, device)
-    make_cutouts = MakeCutouts(cut_size=clip_size, num_cutouts=num_cutouts)
+    make_cutouts = MakeCutouts(cut_size=clip_size, num_cutouts=num_cutouts, mean=CLIP_MEAN, std=CLIP_STD).to(device)
     pil_img = Image.open(script_util.fetch(image)).convert('RGB')
     smallest_side = min(diffusion_size, *pil_img.size)
     pil_img = resize_right.resize(input, out_shape=[smallest_side],
                                   interp_method=lanczos3, support_sz=None,
                                   antialiasing=True, by_convs=False, scale_tolerance=None)
-    batch = make_cutouts(tvf.to_tensor(pil_img).unsqueeze(0).to(device))
-    batch_embed = clip_model.encode_image(tf.normalize(batch)).float()
+    batch = make_cutouts(tvf.to_tensor(pil_img).unsqueeze(0).to(device).mul(2).sub(1))
+    batch_embed = clip_model.encode_image(batch).float()
     batch_weight = [weight / make_cutouts.cutn] * make_cutouts.cutn
     return batch_embed, batch_weight
 
 
 def encode_text_prompt(txt, weight, clip_model_name="ViT-B/32", device="cpu"):
     clip_model, _ = load_clip(clip_model_name, device)
-    txt_tokens = clip.tokenize(txt).to(device)
-    txt_encoded = clip_model.encode_text(txt_tokens).float()
+    txt_tokens = tokenize((txt,), device)
+    txt_encoded = encode_text_truncated(clip_model, txt_tokens).float()
     return txt_encoded, weight
+
+
+def encode_text_prompts(txts: list, weights: list, clip_model_name="ViT-B/32", device="cpu"):
+    """
+    Encodes every text prompt with a single clip forward pass.
+    """
+    clip_model, _ = load_clip(clip_model_name, device)
+    txt_tokens = tokenize(tuple(txts), device)
+    txt_encoded = encode_text_truncated(clip_model, txt_tokens).float()
+    return txt_encoded, list(weights)
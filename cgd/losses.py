@@ -14,9 +14,17 @@ def spherical_dist_loss(x: th.Tensor, y: th.Tensor):
     return (x - y).norm(dim=-1).div(2).arcsin().pow(2).mul(2)
 
 
+def pairwise_spherical_dist_loss(x: th.Tensor, y: th.Tensor):
+    """Spherical distance loss between every x of shape [..., d] and every y of shape [m, d], returns [..., m]"""
+    x = tf.normalize(x, dim=-1)
+    y = tf.normalize(y, dim=-1)
+    cos = x @ y.transpose(0, 1)  # ||x - y|| / 2 == sqrt((1 - cos) / 2) for unit vectors
+    return (1 - cos).div(2).clamp(min=0).sqrt().arcsin().pow(2).mul(2)
+
+
 def tv_loss(input: th.Tensor):
     """(Katherine Crowson) - L2 total variation loss, as in Mahendran et al."""
-    input = tf.pad(input, (0, 1, 0, 1), "replicate")
-    x_diff = input[..., :-1, 1:] - input[..., :-1, :-1]
-    y_diff = input[..., 1:, :-1] - input[..., :-1, :-1]
-    return (x_diff ** 2 + y_diff ** 2).mean([1, 2, 3])
+    # Equivalent to replicate padding the last row/column (their differences are 0) without copying the input.
+    x_diff = input[..., :, 1:] - input[..., :, :-1]
+    y_diff = input[..., 1:, :] - input[..., :-1, :]
+    return (x_diff.pow(2).sum([1, 2, 3]) + y_diff.pow(2).sum([1, 2, 3])) / input[0].numel()
@@ -3,11 +3,20 @@ import torch.nn.functional as tf
 import torchvision.transforms as tvt
 
 class MakeCutouts(th.nn.Module):
-    def __init__(self, cut_size: int, num_cutouts: int, cutout_size_power: float = 1.0, use_augs: bool = False):
+    def __init__(self, cut_size: int, num_cutouts: int, cutout_size_power: float = 1.0, use_augs: bool = False, mean=None, std=None):
         super().__init__()
         self.cut_size = cut_size
         self.cutn = num_cutouts
         self.cut_pow = cutout_size_power
+        self.use_augs = use_augs
+        # With `mean` and `std` set, input is expected in [-1, 1] and cutouts are returned normalized.
+        # Cropping and pooling average pixels, so `((x + 1) / 2 - mean) / std` is folded into one `addcmul` over the cutouts.
+        self.normalize = mean is not None and std is not None
+        if self.normalize:
+            std = th.tensor(std).view(1, 3, 1, 1)
+            mean = th.tensor(mean).view(1, 3, 1, 1)
+            self.register_buffer('scale', 0.5 / std)
+            self.register_buffer('shift', (0.5 - mean) / std)
         if use_augs:
             self.augs = tvt.Compose([
                 tvt.RandomHorizontalFlip(p=0.5),
@@ -22,18 +31,52 @@ class MakeCutouts(th.nn.Module):
         else:
             self.augs = tvt.Compose([])
 
+    def pooling_weights(self, sizes: th.Tensor, offsets: th.Tensor, length: int, dtype: th.dtype):
+        """
+        Per cutout [num_cutouts, cut_size, length] matrices that crop `sizes` pixels starting at `offsets`
+        and average them into `cut_size` bins, using the same bins as `adaptive_avg_pool2d`.
+        """
+        bins = th.arange(self.cut_size, device=sizes.device).view(1, -1, 1)
+        sizes, offsets = sizes.view(-1, 1, 1), offsets.view(-1, 1, 1)
+        starts = offsets + bins * sizes // self.cut_size
+        ends = offsets + ((bins + 1) * sizes + self.cut_size - 1) // self.cut_size
+        pixels = th.arange(length, device=sizes.device).view(1, 1, -1)
+        weights = ((pixels >= starts) & (pixels < ends)).to(dtype)
+        return weights / (ends - starts).to(dtype)
+
+    def sample_cutouts(self, input: th.Tensor, sizes: th.Tensor, offsets_x: th.Tensor, offsets_y: th.Tensor):
+        """Crops and pools every cutout of every batch item with one einsum, without copying `input` per cutout."""
+        n, channels, height, width = input.shape
+        weights_y = self.pooling_weights(sizes, offsets_y, height, input.dtype)
+        weights_x = self.pooling_weights(sizes, offsets_x, width, input.dtype)
+        cutouts = th.einsum('kih,nchw,kjw->kncij', weights_y, input, weights_x)
+        return cutouts.reshape(sizes.shape[0] * n, channels, self.cut_size, self.cut_size)
+
     def forward(self, input: th.Tensor):
         side_x, side_y = input.shape[2:4]
         max_size = min(side_y, side_x)
         min_size = min(side_y, side_x, self.cut_size)
-        cutouts = []
-        for _ in range(self.cutn):
-            size = int(th.rand([])**self.cut_pow * (max_size - min_size) + min_size)
-            offsetx = th.randint(0, side_x - size + 1, ())
-            offsety = th.randint(0, side_y - size + 1, ())
-            cutout = input[:, :, offsety:offsety + size, offsetx:offsetx + size]
-            cutout = self.augs(cutout)
-            cutout = tf.adaptive_avg_pool2d(cutout, self.cut_size)
-            cutouts.append(cutout)
-    
-        return th.cat(cutouts)
+        if self.use_augs:  # augmentations are drawn per cutout
+            if self.normalize:  # augmentation fill values and noise are defined for [0, 1] input
+                input = input.add(1).div(2)
+            cutouts = []
+            for _ in range(self.cutn):
+                size = int(th.rand([])**self.cut_pow * (max_size - min_size) + min_size)
+                offsetx = th.randint(0, side_x - size + 1, ())
+                offsety = th.randint(0, side_y - size + 1, ())
+                cutout = input[:, :, offsety:offsety + size, offsetx:offsetx + size]
+                cutout = self.augs(cutout)
+                cutout = tf.adaptive_avg_pool2d(cutout, self.cut_size)
+                cutouts.append(cutout)
+            cutouts = th.cat(cutouts)
+            if self.normalize:  # already rescaled to [0, 1], so only `(x - mean) / std` is left
+                return th.addcmul(self.shift - self.scale, cutouts, 2 * self.scale)
+        else:
+            height, width = input.shape[2:4]
+            sizes = (th.rand([self.cutn], device=input.device)**self.cut_pow * (max_size - min_size) + min_size).long()
+            offsets_x = (th.rand([self.cutn], device=input.device) * (width - sizes + 1)).long()
+            offsets_y = (th.rand([self.cutn], device=input.device) * (height - sizes + 1)).long()
+            cutouts = self.sample_cutouts(input, sizes, offsets_x, offsets_y)
+        if self.normalize:
+            return th.addcmul(self.shift, cutouts, self.scale)
+        return cutouts
@@ -157,6 +157,7 @@ def load_guided_diffusion(
     device: str = '',
     noise_schedule: str = 'linear',
     dropout: float = 0.0,
+    use_checkpoint: bool = False,
 ):
     '''
     checkpoint_path: path to the checkpoint to load.
@@ -164,6 +165,7 @@ def load_guided_diffusion(
     class_cond: whether to condition on the class label
     diffusion_steps: number of diffusion steps
     timestep_respacing: whether to use timestep-respacing or not
+    use_checkpoint: whether to recompute activations during the backward pass (gradient checkpointing)
     '''
     if not (len(device) > 0):
         raise ValueError("device must be set")
@@ -180,13 +182,18 @@ def load_guided_diffusion(
         "use_fp16": use_fp16,
         "noise_schedule": noise_schedule,
         "dropout": dropout,
+        "use_checkpoint": use_checkpoint,
     })
     model, diffusion = create_model_and_diffusion(**model_config)
     model.load_state_dict(th.load(checkpoint_path, map_location='cpu'))
     model.requires_grad_(False).eval().to(device)
     for name, param in model.named_parameters():
-        if "qkv" in name or "norm" in name or "proj" in name:
+        # guided-diffusion's `CheckpointFunction` differentiates w.r.t. the params of every checkpointed block,
+        # attention blocks always checkpoint and res blocks only do with `use_checkpoint`.
+        if use_checkpoint or "qkv" in name or "norm" in name or "proj" in name:
             param.requires_grad_()
     if model_config["use_fp16"]:
         model.convert_to_fp16()
+    if "cuda" in device:  # lets cudnn pick tensor core convolution kernels
+        model.to(memory_format=th.channels_last)
     return model.to(device), diffusion
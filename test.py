@@ -103,6 +103,22 @@ class TestTorchUtil(unittest.TestCase):
         self.assertIsInstance(model, th.nn.Module)
         self.assertIsInstance(diffusion, respace.SpacedDiffusion)
 
+    def test_load_guided_diffusion_use_checkpoint_grads_all_params(self):
+        image_size = 64
+        checkpoint_path = Path(script_util.CACHE_PATH).joinpath(
+            f"{image_size}x{image_size}_diffusion.pt")
+        model, _ = script_util.load_guided_diffusion(
+            checkpoint_path=str(checkpoint_path),
+            image_size=image_size,
+            class_cond=True,
+            diffusion_steps=1000,
+            timestep_respacing='25',
+            use_fp16=False,
+            device='cpu',
+            use_checkpoint=True,
+        )
+        self.assertTrue(all(param.requires_grad for param in model.parameters()))
+
     def test_log_image(self):
         image = th.rand(3, 3, 3)
         txts = ['a', 'b', 'c']
@@ -127,6 +143,23 @@ class TestTorchUtil(unittest.TestCase):
         expected = (x_norm - y_norm).norm(dim=-1).div(2).arcsin().pow(2).mul(2)
         self.assertEqual(result, expected)
 
+    def test_pairwise_spherical_dist_loss(self):
+        x = th.rand(4, 2, 3)
+        y = th.rand(5, 3)
+        result = losses.pairwise_spherical_dist_loss(x, y)
+        expected = losses.spherical_dist_loss(x.unsqueeze(2), y)
+        self.assertEqual(result.shape, (4, 2, 5))
+        self.assertTrue(th.allclose(result, expected, atol=1e-5))
+
+    def test_tv_loss(self):
+        x = th.rand(2, 3, 8, 8)
+        result = losses.tv_loss(x)
+        padded = tf.pad(x, (0, 1, 0, 1), "replicate")
+        x_diff = padded[..., :-1, 1:] - padded[..., :-1, :-1]
+        y_diff = padded[..., 1:, :-1] - padded[..., :-1, :-1]
+        expected = (x_diff ** 2 + y_diff ** 2).mean([1, 2, 3])
+        self.assertTrue(th.allclose(result, expected))
+
 
 class TestCGD(unittest.TestCase):
     def __init__(self, methodName: str) -> None:
@@ -142,6 +175,13 @@ class TestCGD(unittest.TestCase):
         first_yielded_sample = list(itertools.islice(samples, 1))[0]
         self.assertIsNotNone(first_yielded_sample)
 
+    def test_cgd_use_checkpoint_one_step_succeeds_cpu(self):
+        samples = clip_guided_diffusion(prompts=["Loose seal."], image_size=64, timestep_respacing='25',
+                                        num_cutouts=1, clip_model_name="RN50", prefix_path=self.test_dir_path,
+                                        device='cpu', use_checkpoint=True)
+        first_yielded_sample = list(itertools.islice(samples, 1))[0]
+        self.assertIsNotNone(first_yielded_sample)
+
     def test_cgd_init_fails_with_default_params(self):
         try:
             samples = clip_guided_diffusion(prompts=["Loose seal."], init_image='images/photon.png',
@@ -202,6 +242,11 @@ class TestClipUtil(unittest.TestCase):
         result_scores = clip_util.imagenet_top_n(text_encodes=text, device=device, n=100, clip_model_name=clip_model_name)
         print(result_scores)
 
+    def test_imagenet_top_n_all_classes_skips_ranking(self):
+        text = th.rand(1, 512)
+        result = clip_util.imagenet_top_n(text_encodes=text, device="cpu", n=1000)
+        self.assertTrue(th.equal(result, th.arange(1000)))
+
     def test_load_clip_rn50_cpu(self):
         model_name = "RN50"
         clip_model, clip_size = clip_util.load_clip(model_name=model_name, device="cpu")
@@ -248,6 +293,45 @@ class TestClipUtil(unittest.TestCase):
         self.assertEqual(result.shape[2], cut_size)
         self.assertEqual(result.shape[3], cut_size)
 
+    def test_make_cutouts_normalized_matches_clip_normalize(self):
+        cut_size = 32
+        num_cutouts = 4
+        input = th.rand(1, 3, 64, 64).mul(2).sub(1)
+        make_cutouts = modules.MakeCutouts(cut_size=cut_size, num_cutouts=num_cutouts,
+                                           mean=clip_util.CLIP_MEAN, std=clip_util.CLIP_STD)
+        th.manual_seed(0)
+        result = make_cutouts(input)
+        make_cutouts.normalize = False
+        th.manual_seed(0)
+        expected = clip_util.CLIP_NORMALIZE(make_cutouts(input.add(1).div(2)))
+        self.assertTrue(th.allclose(result, expected, atol=1e-5))
+
+    def test_make_cutouts_normalized_with_augs_matches_clip_normalize(self):
+        input = th.rand(1, 3, 64, 64).mul(2).sub(1)
+        make_cutouts = modules.MakeCutouts(cut_size=32, num_cutouts=4, use_augs=True,
+                                           mean=clip_util.CLIP_MEAN, std=clip_util.CLIP_STD)
+        th.manual_seed(0)
+        result = make_cutouts(input)
+        make_cutouts.normalize = False
+        th.manual_seed(0)
+        expected = clip_util.CLIP_NORMALIZE(make_cutouts(input.add(1).div(2)))
+        self.assertTrue(th.allclose(result, expected, atol=1e-5))
+
+    def test_make_cutouts_sample_cutouts_matches_slicing(self):
+        cut_size = 16
+        input = th.rand(2, 3, 48, 40)
+        make_cutouts = modules.MakeCutouts(cut_size=cut_size, num_cutouts=4)
+        sizes = th.tensor([16, 32, 23, 9])
+        offsets_x = th.tensor([0, 8, 17, 31])
+        offsets_y = th.tensor([32, 0, 5, 39])
+        result = make_cutouts.sample_cutouts(input, sizes, offsets_x, offsets_y)
+        expected = th.cat([
+            tf.adaptive_avg_pool2d(input[:, :, offsety:offsety + size, offsetx:offsetx + size], cut_size)
+            for size, offsetx, offsety in zip(sizes.tolist(), offsets_x.tolist(), offsets_y.tolist())
+        ])
+        self.assertEqual(result.shape, expected.shape)
+        self.assertTrue(th.allclose(result, expected, atol=1e-5))
+
     def test_make_cutouts_to_cuda(self):
         cut_size = 224
         num_cutouts = 8
@@ -280,4 +364,38 @@ class TestClipUtil(unittest.TestCase):
         device = "cuda:0"
         result_encode, result_weight = clip_util.encode_text_prompt(clip_model_name=clip_model_name, txt=text, weight=weight, device=device)
         self.assertEqual(str(result_encode.device), device)
-        self.assertEqual(result_weight, weight)
\ No newline at end of file
+        self.assertEqual(result_weight, weight)
+
+    def test_clip_encode_text_prompts_batched_cpu(self):
+        clip_model_name = "RN50"
+        texts = ["A", "B"]
+        weights = [0.5, -0.5]
+        result_encode, result_weights = clip_util.encode_text_prompts(texts, weights, clip_model_name=clip_model_name, device="cpu")
+        self.assertEqual(result_encode.shape[0], len(texts))
+        self.assertEqual(result_weights, weights)
+
+    def test_encode_text_truncated_matches_encode_text_cpu(self):
+        clip_model, _ = clip_util.load_clip(model_name="RN50", device="cpu")
+        tokens = clip_util.tokenize(("A", "Loose seal in the style of a painting.", "What?!! Loose seal!?!"), "cpu")
+        with th.no_grad():
+            result = clip_util.encode_text_truncated(clip_model, tokens)
+            expected = clip_model.encode_text(tokens)
+        self.assertTrue(th.allclose(result, expected, atol=1e-4))
+
+    @unittest.skipUnless(th.cuda.is_available(), "requires cuda")
+    def test_clip_encode_text_prompts_after_load_clip_cuda(self):
+        clip_model, _ = clip_util.load_clip(model_name="RN50", device="cuda")
+        result_encode, _ = clip_util.encode_text_prompts(["Loose seal."], [1.0], clip_model_name="RN50", device="cuda")
+        self.assertEqual(result_encode.shape, (1, clip_model.text_projection.shape[1]))
+        self.assertTrue(th.isfinite(result_encode).all())
+
+    @unittest.skipUnless(th.cuda.is_available() and hasattr(th.cuda, "make_graphed_callables"), "requires cuda and torch >= 1.10")
+    def test_graph_image_encoder_vit_b_32_matches_encode_image_cuda(self):
+        clip_model, clip_size = clip_util.load_clip(model_name="ViT-B/32", device="cuda")
+        encode_image = clip_util.graph_image_encoder(clip_model, 2, clip_size)
+        image = th.rand(2, 3, clip_size, clip_size, device="cuda").requires_grad_()
+        result = encode_image(image)
+        expected = clip_model.encode_image(image)
+        self.assertTrue(th.allclose(result.float(), expected.float(), atol=1e-2))
+        image_grad = th.autograd.grad(result.float().sum(), image)[0]
+        self.assertTrue(th.isfinite(image_grad).all())